@@ -2,7 +2,6 @@ import os
 import pandas as pd
 import numpy as np
 import sklearn.metrics as sk_metrics
-from sklearn.metrics.pairwise import rbf_kernel
 
 from . import metrics
 from . import kde_lib
@@ -36,6 +35,7 @@ class Density_model:
         self.jensen = None
         self.auc_anomaly = None
         self.X_data = None
+        self.X_data_sqnorm = None
 
     def fit(self, X, X_plot, grid, k='auto', norm_mom=True, hstd_mom=False):
         """
@@ -84,6 +84,7 @@ class Density_model:
                                                        return_model=True)
         elif self.algo == 'rkde-hampel':
             self.X_data = X
+            self.X_data_sqnorm = (X * X).sum(axis=1)
             self.density, self.model = kde_lib.rkde(X,
                                                     X_plot,
                                                     self.bandwidth,
@@ -91,6 +92,7 @@ class Density_model:
                                                     return_model=True)
         elif self.algo == 'rkde-huber':
             self.X_data = X
+            self.X_data_sqnorm = (X * X).sum(axis=1)
             self.density, self.model = kde_lib.rkde(X,
                                                     X_plot,
                                                     self.bandwidth,
@@ -98,6 +100,7 @@ class Density_model:
                                                     return_model=True)
         elif self.algo == 'spkde':
             self.X_data = X
+            self.X_data_sqnorm = (X * X).sum(axis=1)
             self.density, self.model = kde_lib.spkde(X,
                                                      X_plot,
                                                      self.bandwidth,
@@ -156,32 +159,19 @@ class Density_model:
             self.density = np.exp(model.score_samples(X))
         elif self.algo == 'mom-kde':
             # model : list of kdes scikit-learn
-            z = []
-            for k in range(len(model)):
-                kde_k = model[k]
-                z.append(np.exp(kde_k.score_samples(X)))
-            self.density = np.median(z, axis=0)
-        elif self.algo == 'rkde':
+            z = np.empty((len(model), X.shape[0]))
+            for k, kde_k in enumerate(model):
+                z[k] = np.exp(kde_k.score_samples(X))
+            self.density = kde_lib.pointwise_median(z)
+        elif self.algo.startswith('rkde'):
             # model : weights vector w
-            n_samples, d = self.X_data.shape
-            m = X.shape[0]
-            K_plot = np.zeros((m, n_samples))
-            for i_d in range(d):
-                temp_xpos = X[:, i_d].reshape((-1, 1))
-                temp_x = self.X_data[:, i_d].reshape((-1, 1))
-                K_plot = K_plot + (np.dot(np.ones((m, 1)), temp_x.T) - np.dot(temp_xpos, np.ones((1, n_samples))))**2
-            K_plot = kde_lib.gaussian_kernel(K_plot, self.bandwidth, d)
+            K_plot = kde_lib.gaussian_gram(X, self.X_data, self.bandwidth, sq_y=self.X_data_sqnorm)
             z = np.dot(K_plot, model)
             self.density = z
         elif self.algo == 'spkde':
             # model : weights vector a
-            d = self.X_data.shape[1]
-            gamma = 1. / (2 * (self.bandwidth**2))
-            GG = rbf_kernel(self.X_data, X, gamma=gamma) * (2 * np.pi * self.bandwidth**2)**(-d / 2.)
-            z = np.zeros((X.shape[0]))
-            for j in range(X.shape[0]):
-                for i in range(len(model)):
-                    z[j] += model[i] * GG[i, j]
+            GG = kde_lib.gaussian_gram(self.X_data, X, self.bandwidth, sq_x=self.X_data_sqnorm)
+            z = np.dot(model, GG)
             self.density = z
         else:
             print('no algo specified')
@@ -1,69 +1,213 @@
 import numpy as np
-from cvxopt import matrix, solvers
-from scipy.spatial.distance import euclidean
-from sklearn.metrics.pairwise import rbf_kernel
+from joblib import Parallel, delayed
+from numba import njit, prange
+from cvxopt import matrix, solvers, spmatrix
+from scipy.spatial.distance import pdist, squareform
 from sklearn.model_selection import GridSearchCV, KFold, LeaveOneOut
 from sklearn.neighbors import KernelDensity
 
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _gaussian_kernel(x, gamma, scale):
+    """
+    scale * exp(-gamma * x) in a single pass over the flat array x
+    """
+    K = np.empty_like(x)
+    for i in prange(x.shape[0]):
+        K[i] = np.exp(-gamma * x[i]) * scale
+    return K
+
 
 def gaussian_kernel(X, h, d):
     """
     Apply gaussian kernel to the input distance X
     """
-    K = np.exp(-X / (2 * (h ** 2))) / ((2 * np.pi * (h ** 2)) ** (d / 2))
-    return K
+    X = np.asarray(X, dtype=np.float64)
+    gamma = 1.0 / (2 * (h ** 2))
+    scale = (2 * np.pi * (h ** 2)) ** (-d / 2)
+    return _gaussian_kernel(X.ravel(), gamma, scale).reshape(X.shape)
 
 
-def rho(x, typ="hampel", a=0, b=0, c=0):
+@njit(parallel=True, fastmath=True, cache=True)
+def _gaussian_gram(XY, sq_x, sq_y, gamma, scale):
     """
-    Rho function for Huber and Hampel loss
+    In place XY <- scale * exp(-gamma * (sq_x + sq_y - 2 XY)), XY holding the inner products
+    """
+    for i in prange(XY.shape[0]):
+        for j in range(XY.shape[1]):
+            dist = max(sq_x[i] + sq_y[j] - 2 * XY[i, j], 0.0)
+            XY[i, j] = np.exp(-gamma * dist) * scale
+    return XY
 
-    :param x: data point
-    :param typ: 'huber' or 'hampel
-    :param a: threshold parameter
-    :param b: threshold parameter
-    :param c: threshold parameter
 
+def _use_gpu(device):
+    """
+    Resolve the device argument, 'auto' picks the GPU when cupy finds one
+    """
+    if device == "auto":
+        return cupy is not None and cupy.cuda.is_available()
+    if device == "gpu":
+        if cupy is None:
+            raise ValueError("device='gpu' requires cupy to be installed")
+        return True
+    if device == "cpu":
+        return False
+    raise ValueError("Wrong value for argument device: " + device)
+
+
+def _gaussian_gram_gpu(X, Y, h, sq_x=None, sq_y=None):
+    """
+    gaussian_gram computed with cupy, the result stays on the device
+    """
+    X = cupy.asarray(X, dtype=cupy.float64)
+    Y = cupy.asarray(Y, dtype=cupy.float64)
+    d = X.shape[1]
+    sq_x = (X * X).sum(axis=1) if sq_x is None else cupy.asarray(sq_x)
+    sq_y = (Y * Y).sum(axis=1) if sq_y is None else cupy.asarray(sq_y)
+    D = cupy.dot(X, Y.T)
+    D *= -2
+    D += sq_x[:, None]
+    D += sq_y[None, :]
+    cupy.maximum(D, 0, out=D)
+    D *= -1.0 / (2 * (h ** 2))
+    cupy.exp(D, out=D)
+    D *= (2 * np.pi * h ** 2) ** (-d / 2.0)
+    return D
+
+
+def gaussian_gram(X, Y, h, device="cpu", sq_x=None, sq_y=None):
+    """
+    Gaussian kernel matrix between X and Y, normalized by (2 pi h^2)^(-d/2)
 
-    :return: value of rho function at x
+    Equivalent to rbf_kernel(X, Y, gamma=1 / (2 h^2)) * (2 pi h^2)^(-d/2), but the
+    exponential and the scaling are applied in a single pass over the
+    inner products X Y^T.
+
+    :param X: array (n, d)
+    :param Y: array (m, d)
+    :param h: bandwidth
+    :param device: 'cpu', 'gpu' or 'auto'. On the GPU a cupy array is returned
+    :param sq_x: optional precomputed squared norms of the rows of X
+    :param sq_y: optional precomputed squared norms of the rows of Y
+    :return: kernel matrix (n, m)
     """
-    if typ == "huber":
-        in1 = x <= a
-        in2 = x > a
-        in1_t = x[in1] ** 2 / 2
-        in2_t = x[in2] * a - a ** 2 / 2
-        L = np.sum(in1_t) + np.sum(in2_t)
-    if typ == "hampel":
-        in1 = x < a
-        in2 = np.logical_and(a <= x, x < b)
-        in3 = np.logical_and(b <= x, x < c)
-        in4 = c <= x
-        in1_t = (x[in1] ** 2) / 2
-        in2_t = a * x[in2] - a ** 2 / 2
-        in3_t = (a * (x[in3] - c) ** 2 / (2 * (b - c))) + a * (b + c - a) / 2
-        in4_t = np.ones(x[in4].shape) * a * (b + c - a) / 2
-        L = np.sum(in1_t) + np.sum(in2_t) + np.sum(in3_t) + np.sum(in4_t)
-    if typ == "square":
-        t = x ** 2
-    if typ == "abs":
-        t = np.abs(x)
-        L = np.sum(t)
+    if _use_gpu(device):
+        return _gaussian_gram_gpu(X, Y, h, sq_x, sq_y)
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    d = X.shape[1]
+    if sq_x is None:
+        sq_x = (X * X).sum(axis=1)
+    if sq_y is None:
+        sq_y = sq_x if Y is X else (Y * Y).sum(axis=1)
+    gamma = 1.0 / (2 * (h ** 2))
+    scale = (2 * np.pi * h ** 2) ** (-d / 2.0)
+    return _gaussian_gram(
+        np.dot(X, Y.T),
+        np.asarray(sq_x, dtype=np.float64),
+        np.asarray(sq_y, dtype=np.float64),
+        gamma,
+        scale,
+    )
 
-    return L / x.shape[0]
 
+_RHO_CODES = {"huber": 0, "hampel": 1, "abs": 2, "square": 3}
+
+
+def _rho_code(typ):
+    if typ not in _RHO_CODES:
+        raise ValueError("Wrong value for argument typ: " + typ)
+    return _RHO_CODES[typ]
+
+
+@njit(fastmath=True, cache=True)
+def _rho_scalar(x, rho_code, a, b, c):
+    if rho_code == 0:
+        if x <= a:
+            return x * x / 2
+        return x * a - a * a / 2
+    if rho_code == 1:
+        if x < a:
+            return x * x / 2
+        if x < b:
+            return a * x - a * a / 2
+        if x < c:
+            return a * (x - c) ** 2 / (2 * (b - c)) + a * (b + c - a) / 2
+        return a * (b + c - a) / 2
+    if rho_code == 2:
+        return abs(x)
+    return x * x
+
+
+@njit(fastmath=True, cache=True)
+def _psi_scalar(x, rho_code, a, b, c):
+    if rho_code == 0:
+        return min(x, a)
+    if rho_code == 1:
+        if x < a:
+            return x
+        if x < b:
+            return a
+        if x < c:
+            return a * (c - x) / (c - b)
+        return 0.0
+    if rho_code == 2:
+        return 1.0
+    return 2 * x
+
+
+@njit(fastmath=True, cache=True)
+def _phi_scalar(x, rho_code, a, b, c):
+    if x == 0:
+        x = 10e-6
+    return _psi_scalar(x, rho_code, a, b, c) / x
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _rho_sum(x, rho_code, a, b, c):
+    L = 0.0
+    for i in prange(x.shape[0]):
+        L += _rho_scalar(x[i], rho_code, a, b, c)
+    return L
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _psi_map(x, rho_code, a, b, c):
+    out = np.empty_like(x)
+    for i in prange(x.shape[0]):
+        out[i] = _psi_scalar(x[i], rho_code, a, b, c)
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _phi_map(x, rho_code, a, b, c):
+    out = np.empty_like(x)
+    for i in prange(x.shape[0]):
+        out[i] = _phi_scalar(x[i], rho_code, a, b, c)
+    return out
 
-def loss(x, typ="hampel", a=0, b=0, c=0):
+
+def rho(x, typ="hampel", a=0, b=0, c=0):
     """
-    Compute Huber or Hampel loss
+    Rho function for Huber and Hampel loss
 
     :param x: data point
-    :param typ: 'huber' or 'hampel'
+    :param typ: 'huber', 'hampel', 'abs' or 'square'
     :param a: threshold parameter
     :param b: threshold parameter
     :param c: threshold parameter
-    :return: Loss
+
+
+    :return: value of rho function at x
     """
-    return rho(x, typ=typ, a=a, b=b, c=c) / x.shape[0]
+    x = np.asarray(x, dtype=np.float64)
+    L = _rho_sum(x.ravel(), _rho_code(typ), float(a), float(b), float(c))
+    return L / x.shape[0]
 
 
 def psi(x, typ="hampel", a=0, b=0, c=0):
@@ -71,29 +215,16 @@ def psi(x, typ="hampel", a=0, b=0, c=0):
     Compute Huber or Hampel psu function
 
     :param x: data point
-    :param typ: 'huber' or 'hampel'
+    :param typ: 'huber', 'hampel', 'abs' or 'square'
     :param a: threshold parameter
     :param b: threshold parameter
     :param c: threshold parameter
 
-    :return: Value of psi function
-    """
-    if typ == "huber":
-        return np.minimum(x, a)
-    if typ == "hampel":
-        in1 = x < a
-        in2 = np.logical_and(a <= x, x < b)
-        in3 = np.logical_and(b <= x, x < c)
-        in4 = c <= x
-        in1_t = x[in1]
-        in2_t = np.ones(x[in2].shape) * a
-        in3_t = a * (c - x[in3]) / (c - b)
-        in4_t = np.zeros(x[in4].shape)
-        return np.concatenate((in1_t, in2_t, in3_t, in4_t)).reshape((-1, x.shape[1]))
-    if typ == "square":
-        return 2 * x
-    if typ == "abs":
-        return 1
+    :return: Value of psi function, same shape as x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    out = _psi_map(x.ravel(), _rho_code(typ), float(a), float(b), float(c))
+    return out.reshape(x.shape)
 
 
 def phi(x, typ="hampel", a=0, b=0, c=0):
@@ -101,51 +232,182 @@ def phi(x, typ="hampel", a=0, b=0, c=0):
     Compute Huber or Hampel phi
 
     :param x: data point
-    :param typ: 'huber' or 'hampel'
+    :param typ: 'huber', 'hampel', 'abs' or 'square'
     :param a: threshold parameter
     :param b: threshold parameter
     :param c: threshold parameter
-    :return: Value of phi function
+    :return: Value of phi function, same shape as x
     """
-    x[x == 0] = 10e-6
-    return psi(x, typ=typ, a=a, b=b, c=c) / x
+    x = np.asarray(x, dtype=np.float64)
+    out = _phi_map(x.ravel(), _rho_code(typ), float(a), float(b), float(c))
+    return out.reshape(x.shape)
 
 
-def irls(Km, type_rho, n, a, b, c, alpha=10e-8, max_it=100):
+@njit(parallel=True, fastmath=True, cache=True)
+def _irls_pass(t1, Kw, t3, rho_code, a, b, c, norm, w_next):
     """
-    Iterative reweighted least-square
+    norm = sqrt(t1 + t2 + t3), loss and unnormalized next weights in a single pass
+
+    :return: sum of rho over the norms, sum of the next weights
+    """
+    L = 0.0
+    w_sum = 0.0
+    for i in prange(Kw.shape[0]):
+        x = np.sqrt(max(t1[i] - 2 * Kw[i] + t3, 0.0))
+        L += _rho_scalar(x, rho_code, a, b, c)
+        if x == 0:
+            x = 10e-6
+        norm[i] = x
+        p = _phi_scalar(x, rho_code, a, b, c)
+        w_next[i] = p
+        w_sum += p
+    return L, w_sum
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _irls_numba(Km, rho_code, a, b, c, alpha, max_it):
+    """
+    Jitted IRLS core, see irls. rho_code is one of _RHO_CODES
     """
-    # init weights
-    w = np.ones((n, 1)) / n
-    # first pass
-    t1 = np.diag(Km).reshape((-1, 1))  #  (-1, dimension)
-    t2 = -2 * np.dot(Km, w)
-    t3 = np.dot(np.dot(w.T, Km), w)
-    t = t1 + t2 + t3
-    norm = np.sqrt(t)
-    J = loss(norm, typ=type_rho, a=a, b=b, c=c)
-    stop = 0
+    n = Km.shape[0]
+    # Km is constant, read its diagonal once
+    t1 = np.diag(Km).copy()
+    w = np.full(n, 1.0 / n)
+    w_next = np.empty(n)
+    Kw = np.empty(n)
+    norm = np.empty(n)
+    losses = np.empty(max_it + 1)
     count = 0
-    losses = [J]
-    while not stop:
+    while True:
+        # t2 = Km w, one pass over the rows of Km
+        for i in prange(n):
+            acc = 0.0
+            for j in range(n):
+                acc += Km[i, j] * w[j]
+            Kw[i] = acc
+        # t3 = w^T Km w
+        t3 = 0.0
+        for i in prange(n):
+            t3 += w[i] * Kw[i]
+        L, w_sum = _irls_pass(t1, Kw, t3, rho_code, a, b, c, norm, w_next)
+        J = L / n
+        losses[count] = J
+        if count > 0:
+            J_old = losses[count - 1]
+            if (np.abs(J - J_old) < (J_old * alpha)) or (count == max_it):
+                break
         count += 1
-        # print("i: {}  loss: {}".format(count, J))
-        J_old = J
         # update weights
-        w = phi(norm, typ=type_rho, a=a, b=b, c=c)
-        w = w / np.sum(w)
-        t1 = np.diag(Km).reshape((-1, 1))  #  (-1, dimension)
-        t2 = -2 * np.dot(Km, w)
-        t3 = np.dot(np.dot(w.T, Km), w)
-        t = t1 + t2 + t3
-        norm = np.sqrt(t)
-        # update loss
-        J = loss(norm, typ=type_rho, a=a, b=b, c=c)
+        for i in prange(n):
+            w[i] = w_next[i] / w_sum
+    return w, norm, losses[: count + 1], count
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _irls_rff_numba(Phi, scale, rho_code, a, b, c, alpha, max_it):
+    """
+    Jitted IRLS core on random Fourier features, Km ~ scale * Phi Phi^T
+    """
+    n = Phi.shape[0]
+    PhiT = np.ascontiguousarray(Phi.T)
+    # diag(Km) = scale for the gaussian kernel
+    t1 = np.full(n, scale)
+    w = np.full(n, 1.0 / n)
+    w_next = np.empty(n)
+    norm = np.empty(n)
+    losses = np.empty(max_it + 1)
+    count = 0
+    while True:
+        # t2 = Km w = scale * Phi (Phi^T w), O(n m) instead of O(n^2)
+        Pw = np.dot(PhiT, w)
+        Kw = scale * np.dot(Phi, Pw)
+        # t3 = w^T Km w = scale * ||Phi^T w||^2
+        t3 = scale * np.dot(Pw, Pw)
+        L, w_sum = _irls_pass(t1, Kw, t3, rho_code, a, b, c, norm, w_next)
+        J = L / n
+        losses[count] = J
+        if count > 0:
+            J_old = losses[count - 1]
+            if (np.abs(J - J_old) < (J_old * alpha)) or (count == max_it):
+                break
+        count += 1
+        # update weights
+        for i in prange(n):
+            w[i] = w_next[i] / w_sum
+    return w, norm, losses[: count + 1], count
+
+
+def _irls_gpu(Km, rho_code, a, b, c, alpha, max_it):
+    """
+    IRLS with Km kept on the GPU: only Km @ w runs on the device, the O(n)
+    elementwise pass runs on the host
+    """
+    n = Km.shape[0]
+    t1 = cupy.asnumpy(cupy.diag(Km))
+    w = np.full(n, 1.0 / n)
+    w_next = np.empty(n)
+    Kw = np.empty(n)
+    norm = np.empty(n)
+    # device buffers reused across iterations
+    w_dev = cupy.empty(n)
+    Kw_dev = cupy.empty(n)
+    losses = []
+    count = 0
+    while True:
+        w_dev.set(w)
+        cupy.dot(Km, w_dev, out=Kw_dev)
+        Kw_dev.get(out=Kw)
+        t3 = np.dot(w, Kw)
+        L, w_sum = _irls_pass(t1, Kw, t3, rho_code, a, b, c, norm, w_next)
+        J = L / n
         losses.append(J)
-        if (np.abs(J - J_old) < (J_old * alpha)) or (count == max_it):
-            print("Stop at {} iterations".format(count))
-            stop = 1
-    return w, norm, losses
+        if count > 0:
+            J_old = losses[-2]
+            if (np.abs(J - J_old) < (J_old * alpha)) or (count == max_it):
+                break
+        count += 1
+        # update weights
+        np.divide(w_next, w_sum, out=w)
+    return w, norm, losses, count
+
+
+def irls(
+    Km, type_rho, n, a, b, c, alpha=10e-8, max_it=100, features=None, scale=1.0
+):
+    """
+    Iterative reweighted least-square
+
+    :param Km: kernel matrix, numpy or cupy array. A cupy array stays on the GPU
+    :param features: random Fourier features Phi (n, m). If given, Km is not used
+        and the kernel matrix is approximated by scale * Phi Phi^T
+    :param scale: kernel normalization, i.e. its (constant) diagonal
+    """
+    if features is not None:
+        Phi = np.ascontiguousarray(features, dtype=np.float64)
+        w, norm, losses, count = _irls_rff_numba(
+            Phi,
+            float(scale),
+            _rho_code(type_rho),
+            float(a),
+            float(b),
+            float(c),
+            alpha,
+            max_it,
+        )
+        print("Stop at {} iterations".format(count))
+        return w.reshape((-1, 1)), norm.reshape((-1, 1)), list(losses)
+    if cupy is not None and isinstance(Km, cupy.ndarray):
+        w, norm, losses, count = _irls_gpu(
+            Km, _rho_code(type_rho), float(a), float(b), float(c), alpha, max_it
+        )
+        print("Stop at {} iterations".format(count))
+        return w.reshape((-1, 1)), norm.reshape((-1, 1)), list(losses)
+    Km = np.ascontiguousarray(Km, dtype=np.float64)
+    w, norm, losses, count = _irls_numba(
+        Km, _rho_code(type_rho), float(a), float(b), float(c), alpha, max_it
+    )
+    print("Stop at {} iterations".format(count))
+    return w.reshape((-1, 1)), norm.reshape((-1, 1)), list(losses)
 
 
 def kde(X_data, X_plot, h, kernel="gaussian", return_model=False):
@@ -166,6 +428,25 @@ def kde(X_data, X_plot, h, kernel="gaussian", return_model=False):
         return np.exp(kde_fit.score_samples(X_plot))
 
 
+def pointwise_median(Z):
+    """
+    Median of the block estimates Z (K, m) at each point, i.e. np.median(Z, axis=0)
+
+    Only the middle element(s) of each column are selected with an in-place
+    partition, without np.median's extra copy and NaN checks. Z is reordered.
+
+    :param Z: array (K, m)
+    :return: array (m,)
+    """
+    K = Z.shape[0]
+    half = K // 2
+    if K % 2:
+        Z.partition(half, axis=0)
+        return Z[half].copy()
+    Z.partition((half - 1, half), axis=0)
+    return 0.5 * (Z[half - 1] + Z[half])
+
+
 def area_density(z, grid):
     """
     Area density
@@ -184,40 +465,62 @@ def area_density(z, grid):
     return area
 
 
-def area_MC_mom(X, model_momkde, n_mc=100000, distribution="kde", h=1):
+def _score_into(res, k, kde, X):
+    """
+    Write the density of X under kde into row k of res
+    """
+    res[k] = np.exp(kde.score_samples(X))
+
+
+def area_MC_mom(X, model_momkde, n_mc=100000, distribution="kde", h=1, n_jobs=-1):
     """
 
     :param distribution : 'uniform', 'kde'
     :param h : if 'kde', need to specifiy the bandwidth h
+    :param n_jobs : number of threads scoring the kdes (joblib convention)
     :return: the area of model_momkde over X
     """
-    cube_lows = []
-    cube_highs = []
     dim = X.shape[1]
     if distribution == "uniform":
+        cube_lows = np.empty(dim)
+        cube_highs = np.empty(dim)
         for d in range(dim):
             x_min, x_max = X[:, d].min(), X[:, d].max()
             offset = np.abs(x_max - x_min) * 0.5
-            cube_lows.append(x_min - offset)
-            cube_highs.append(x_max + offset)
-        x_mc = np.random.uniform(cube_lows, cube_highs, size=(n_mc, X.shape[1]))
-        p_mc = 1 / np.product(np.array(cube_highs) - np.array(cube_lows))
+            cube_lows[d] = x_min - offset
+            cube_highs[d] = x_max + offset
+        x_mc = np.random.uniform(cube_lows, cube_highs, size=(n_mc, dim))
+        p_mc = 1 / np.prod(cube_highs - cube_lows)
     elif distribution == "kde":
-        kde = KernelDensity(h)
+        kde = KernelDensity(bandwidth=h)
         kde.fit(X)
         x_mc = kde.sample(n_mc)
         p_mc = np.exp(kde.score_samples(x_mc))
 
-    res = []
-    for kde_k in model_momkde:
-        res.append(np.exp(kde_k.score_samples(x_mc)))
-    res = np.median(res, axis=0)
+    # kdes are scored independently, threads write into their own row
+    res = np.empty((len(model_momkde), n_mc))
+    Parallel(n_jobs=n_jobs, backend="threading")(
+        delayed(_score_into)(res, k, kde_k, x_mc)
+        for k, kde_k in enumerate(model_momkde)
+    )
+    res = pointwise_median(res)
     res = res / p_mc
     area = np.mean(res)
     # print('area MC: {}'.format(area))
     return area
 
 
+def _fit_score_block(values, h, X_plot):
+    """
+    Fit a KDE on one block and score X_plot
+
+    :return: the fitted kde, density of X_plot
+    """
+    kde = KernelDensity(bandwidth=h)
+    kde.fit(values)
+    return kde, np.exp(kde.score_samples(X_plot))
+
+
 def mom_kde(
     X_data,
     X_plot,
@@ -230,9 +533,11 @@ def mom_kde(
     norm=True,
     return_model=False,
     h_std=False,
+    n_jobs=-1,
 ):
     """
 
+    :param n_jobs: number of jobs used to fit the blocks (joblib convention)
     :return: (if return_model=True) KDE_K: the list of all kdes fitted on the blocks.
         Warning : the KDE_K is not normed to area=1, only z is normed.
     """
@@ -241,10 +546,9 @@ def mom_kde(
         K = int(2 * n_samples * outliers_fraction) + 1
     # print("N blocks: ", K)
     # print("N samples per block: ", int(n_samples / K))
-    KDE_K = []
     X_shuffle = np.array(X_data)
     np.random.shuffle(X_shuffle)
-    z = []
+    blocks = []
     for k in range(K):
         values = X_shuffle[k * int(n_samples / K) : (k + 1) * int(n_samples / K), :]
         if h_std:
@@ -252,18 +556,22 @@ def mom_kde(
             h0 = h * std
         else:
             h0 = h
-        kde = KernelDensity(bandwidth=h0)
-        kde.fit(values)
+        blocks.append((values, h0))
+    # blocks are independent, fit and score them in parallel
+    results = Parallel(n_jobs=n_jobs, prefer="processes")(
+        delayed(_fit_score_block)(values, h0, X_plot) for values, h0 in blocks
+    )
+    KDE_K = []
+    z = np.empty((K, X_plot.shape[0]))
+    for k, (kde, z_k) in enumerate(results):
         KDE_K.append(kde)
-        z.append(np.exp(kde.score_samples(X_plot)))
+        z[k] = z_k
     if median == "pointwise":
-        z = np.median(z, axis=0)
+        z = pointwise_median(z)
     elif median == "geometric":
-        distance = euclidean
-        z = min(
-            map(lambda p1: (p1, sum(map(lambda p2: distance(p1, p2), z))), z),
-            key=lambda x: x[1],
-        )[0]
+        # block estimate minimizing the sum of distances to the others
+        distances = squareform(pdist(z))
+        z = z[distances.sum(axis=1).argmin()]
     else:
         raise ValueError("Wrong value for argument median: " + median)
     if norm:
@@ -280,7 +588,30 @@ def mom_kde(
         return z
 
 
-def rkde(X_data, X_plot, h, type_rho="hampel", return_model=False):
+def random_fourier_features(X, G, b, h):
+    """
+    Random Fourier features of the gaussian kernel with bandwidth h
+
+    :param X: data (n, d)
+    :param G: random directions (m, d), drawn from N(0, 1)
+    :param b: random phases (m,), drawn from U[0, 2 pi]
+    :param h: bandwidth
+    :return: Phi (n, m) such that Phi Phi^T ~ rbf_kernel(X, X, gamma=1 / (2 h^2))
+    """
+    m = G.shape[0]
+    # sqrt(2 gamma) = 1 / h
+    return np.sqrt(2.0 / m) * np.cos(np.dot(X, G.T) / h + b)
+
+
+def rkde(
+    X_data,
+    X_plot,
+    h,
+    type_rho="hampel",
+    return_model=False,
+    rff_features=None,
+    device="auto",
+):
     """
     RKDE implementation
 
@@ -289,37 +620,53 @@ def rkde(X_data, X_plot, h, type_rho="hampel", return_model=False):
     :param h: bandwidth
     :param type_rho: 'huber' or 'hampel'
     :param return_model: Should we return the model?
+    :param rff_features: if not None, number of random Fourier features used to
+        approximate the kernel matrix, avoiding the n x n matrix for large n
+    :param device: 'cpu', 'gpu' or 'auto', where the exact kernel matrices are
+        built and multiplied. 'gpu' requires cupy
     :return: Density estimate of X_plot, models weight vector
     """
-    # kernel matrix
     n_samples, d = X_data.shape
-    gamma = 1.0 / (2 * (h ** 2))
-    Km = rbf_kernel(X_data, X_data, gamma=gamma) * (2 * np.pi * h ** 2) ** (-d / 2.0)
+    if rff_features is None:
+        # kernel matrix
+        Km = gaussian_gram(X_data, X_data, h, device=device)
+        Phi = scale = None
+    else:
+        # Km ~ scale * Phi Phi^T
+        G = np.random.normal(size=(rff_features, d))
+        b_rff = np.random.uniform(0, 2 * np.pi, rff_features)
+        Phi = random_fourier_features(X_data, G, b_rff, h)
+        scale = (2 * np.pi * h ** 2) ** (-d / 2.0)
+        Km = None
     # find a, b, c via iterative reweighted least square
     a = b = c = 0
     alpha = 10e-8
     max_it = 100
     # first it. reweighted least ssquare with rho = absolute function
-    w, norm, losses = irls(Km, "abs", n_samples, a, b, c, alpha, max_it)
+    w, norm, losses = irls(Km, "abs", n_samples, a, b, c, alpha, max_it, Phi, scale)
     a = np.median(norm)
     b = np.percentile(norm, 75)
     c = np.percentile(norm, 95)
     # find weights via second iterative reweighted least square with input rho
-    w, norm, losses = irls(Km, type_rho, n_samples, a, b, c, alpha, max_it)
-    # kernel evaluated on plot data
-    gamma = 1.0 / (2 * (h ** 2))
-    K_plot = rbf_kernel(X_plot, X_data, gamma=gamma) * (2 * np.pi * h ** 2) ** (
-        -d / 2.0
-    )
+    w, norm, losses = irls(Km, type_rho, n_samples, a, b, c, alpha, max_it, Phi, scale)
     # final density
-    z = np.dot(K_plot, w)
+    if rff_features is None:
+        # kernel evaluated on plot data
+        K_plot = gaussian_gram(X_plot, X_data, h, device=device)
+        if cupy is not None and isinstance(K_plot, cupy.ndarray):
+            z = cupy.asnumpy(cupy.dot(K_plot, cupy.asarray(w)))
+        else:
+            z = np.dot(K_plot, w)
+    else:
+        Phi_plot = random_fourier_features(X_plot, G, b_rff, h)
+        z = scale * np.dot(Phi_plot, np.dot(Phi.T, w))
     if return_model:
         return z, w
     else:
         return z
 
 
-def spkde(X_data, X_plot, h, outliers_fraction, return_model=False):
+def spkde(X_data, X_plot, h, outliers_fraction, return_model=False, device="auto"):
     """
     SPKDE implementation
 
@@ -328,44 +675,56 @@ def spkde(X_data, X_plot, h, outliers_fraction, return_model=False):
     :param h:
     :param outliers_fraction:
     :param return_model:
+    :param device: 'cpu', 'gpu' or 'auto', where the kernel matrices are built
     :return:
     """
-    d = X_data.shape[1]
     beta = 1.0 / (1 - outliers_fraction)
-    gamma = 1.0 / (2 * (h ** 2))
-    G = rbf_kernel(X_data, X_data, gamma=gamma) * (2 * np.pi * h ** 2) ** (-d / 2.0)
+    use_gpu = _use_gpu(device)
+    G = gaussian_gram(X_data, X_data, h, device=device)
+    if use_gpu:
+        # the QP is solved on the host
+        G = cupy.asnumpy(G)
 
+    n_samples = X_data.shape[0]
     P = matrix(G)
-    q = matrix(-beta / X_data.shape[0] * np.sum(G, axis=0))
-    G = matrix(-np.identity(X_data.shape[0]))
-    h_solver = matrix(np.zeros(X_data.shape[0]))
-    A = matrix(np.ones((1, X_data.shape[0])))
+    q = matrix(-beta / n_samples * np.sum(G, axis=0))
+    # a >= 0 as a sparse -I, a dense one makes cvxopt form G^T W G in O(n^3)
+    G_solver = spmatrix(-1.0, range(n_samples), range(n_samples))
+    h_solver = matrix(np.zeros(n_samples))
+    A = matrix(np.ones((1, n_samples)))
     b = matrix(1.0)
-    sol = solvers.qp(P, q, G, h_solver, A, b)
+    sol = solvers.qp(P, q, G_solver, h_solver, A, b, options={"show_progress": False})
     a = np.array(sol["x"]).reshape((-1,))
     # final density
-    GG = rbf_kernel(X_data, X_plot, gamma=gamma) * (2 * np.pi * h ** 2) ** (-d / 2.0)
-    z = np.zeros((X_plot.shape[0]))
-    for j in range(X_plot.shape[0]):
-        for i in range(len(a)):
-            z[j] += a[i] * GG[i, j]
+    if X_plot is X_data:
+        # scoring the training data, reuse the (symmetric) kernel matrix of the QP
+        z = np.dot(a, G)
+    else:
+        GG = gaussian_gram(X_data, X_plot, h, device=device)
+        if use_gpu:
+            z = cupy.asnumpy(cupy.dot(cupy.asarray(a), GG))
+        else:
+            z = np.dot(a, GG)
     if return_model:
         return z, a
     else:
         return z
 
 
-def bandwidth_cvgrid(X_data, loo=False, kfold=5, kernel="gaussian"):
+def bandwidth_cvgrid(X_data, loo=False, kfold=5, kernel="gaussian", n_jobs=-1):
     """
     Compute the best bandwidth along a grid search.
 
     :param X_data : input data
+    :param n_jobs : number of jobs evaluating the grid in parallel (joblib convention)
     :return: h : the best bandwidth, sigma : the search grid, osses : the scores along the grid
     """
     print("Finding best bandwidth...")
     sigma = np.logspace(-1.5, 0.5, 80)  # grid for method 2 et 3
     cv = LeaveOneOut() if loo else KFold(n_splits=kfold)
-    grid = GridSearchCV(KernelDensity(kernel=kernel), {"bandwidth": sigma}, cv=cv)
+    grid = GridSearchCV(
+        KernelDensity(kernel=kernel), {"bandwidth": sigma}, cv=cv, n_jobs=n_jobs
+    )
     grid.fit(X_data)
     h = grid.best_params_["bandwidth"]
     losses = grid.cv_results_["mean_test_score"]